@@ -1,40 +1,120 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import joblib
+import onnxruntime as ort
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import datetime
-import shap
-import matplotlib.pyplot as plt
+from google.oauth2.service_account import Credentials
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # ---------------------------------------------------------
 # 1. SETUP & CONFIGURATION
 # ---------------------------------------------------------
 st.set_page_config(page_title="Nephro-AI CDSS", page_icon="🏥")
 
-# Load the Brain
+# Feature flags (one app, one set of caches, instead of separate app variants)
+ENABLE_SHAP = True
+ENABLE_DEBUG = st.query_params.get("debug") == "1"
+
+# Load the Brain (save it with joblib.dump(..., compress=0) so arrays can be memory-mapped)
 @st.cache_resource
-def load_model_v3():
+def load_model():
     try:
-        return joblib.load('Nephro_Brain_Final.pkl')
-    except:
+        return joblib.load('Nephro_Brain_Final.pkl', mmap_mode='r')
+    except (FileNotFoundError, OSError, ModuleNotFoundError) as e:
+        st.error(f"Model load failed: {e}")
         return None
 
-model = load_model_v3()
+model = load_model()
 
-# Database Function
-def add_to_database(data_row):
+# Compiled copy of the Brain for fast scoring (built by export_onnx.py)
+@st.cache_resource
+def load_scorer():
     try:
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        client = gspread.authorize(creds)
-        sheet = client.open("Nephro_DB").sheet1
-        sheet.append_row(data_row)
-        return True
-    except Exception as e:
-        st.error(f"Database Error: {e}")
-        return False
+        return ort.InferenceSession('Nephro_Brain_Final.onnx', providers=['CPUExecutionProvider'])
+    except Exception:
+        return None
+
+scorer = load_scorer()
+
+# Dialysis probability for each row of a feature matrix.
+# Trees split on float32 thresholds, so score in float32 (no copy if already float32).
+def predict_risk(x):
+    x = np.asarray(x, dtype=np.float32)
+    if scorer is not None:
+        return scorer.run(['probabilities'], {'X': x})[0][:, 1]
+    return model.predict_proba(x)[:, 1]
+
+# Risk bands: <= 40% LOW, <= 75% MODERATE, above that HIGH
+RISK_THRESHOLDS = np.array([0.40, 0.75])
+RISK_BANDS = np.array(["LOW", "MODERATE", "HIGH"])
+
+# Band label for each probability (works for one patient or a whole batch)
+def risk_band(probs):
+    return RISK_BANDS[np.searchsorted(RISK_THRESHOLDS, probs)]
+
+# Column order the Brain was trained on
+FEATURES = tuple(model.feature_names_in_) if model is not None else ()
+
+# One reusable feature row per session, filled in place on every submit
+if "xbuf" not in st.session_state:
+    st.session_state.xbuf = np.empty((1, len(FEATURES)), dtype=np.float32)
+
+# Build the SHAP explainer once; it walks every tree in the ensemble.
+# shap is imported here so reruns that never explain anything skip it.
+@st.cache_resource
+def get_explainer(_model):
+    import shap
+    return shap.TreeExplainer(_model)
+
+# SHAP values for recently seen patients (clinicians often re-submit near-identical cases)
+@st.cache_data(ttl=600, max_entries=512)
+def cached_shap(vec_tuple):
+    x = np.asarray(vec_tuple, dtype=np.float32).reshape(1, -1)
+    return get_explainer(model).shap_values(x)[0]
+
+# Connect to Google Sheets once per server process
+@st.cache_resource
+def get_sheet():
+    scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+    creds = Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=scope)
+    client = gspread.authorize(creds)
+    return client.open("Nephro_DB").sheet1
+
+# Background workers so uploads never block the page
+@st.cache_resource
+def get_pool():
+    return ThreadPoolExecutor(max_workers=2)
+
+# Database Function (one HTTP call for the whole batch, runs on a worker thread)
+def add_to_database(data_rows):
+    get_sheet().append_rows(data_rows, value_input_option="RAW")
+
+# Cases waiting to be uploaded; flushed together once the batch is full
+SYNC_BATCH_SIZE = 16
+st.session_state.setdefault("pending_rows", [])
+st.session_state.setdefault("sync_jobs", [])
+
+def flush_pending_rows():
+    pending = st.session_state.pending_rows
+    if pending:
+        rows = list(pending)
+        pending.clear()
+        st.session_state.sync_jobs.append((rows, get_pool().submit(add_to_database, rows)))
+
+# Report uploads that finished since the last run; failed rows go back in the queue
+def check_sync_jobs():
+    running = []
+    for rows, future in st.session_state.sync_jobs:
+        if not future.done():
+            running.append((rows, future))
+        elif future.exception():
+            st.error(f"Database Error: {future.exception()}")
+            st.session_state.pending_rows[:0] = rows
+        else:
+            st.toast(f"✅ Saved {len(rows)} cases for training!", icon="🧬")
+    st.session_state.sync_jobs = running
 
 # ---------------------------------------------------------
 # 2. THE INTERFACE
@@ -42,105 +122,129 @@ def add_to_database(data_row):
 st.title("🏥 Nephro-AI Assistant")
 st.caption("Clinical Decision Support System with Explainability")
 
-with st.form("patient_form"):
-    st.subheader("Patient Vitals & Labs")
-    
-    col1, col2 = st.columns(2)
-    with col1:
-        cr = st.number_input("Creatinine (mg/dL)", min_value=0.0, value=2.0, step=0.1)
-        delta_cr = st.number_input("Delta Cr (24h change)", value=0.0, step=0.1)
-        k = st.number_input("Potassium (mEq/L)", min_value=0.0, value=4.5, step=0.1)
-        bicarb = st.number_input("Bicarbonate (mEq/L)", min_value=0.0, value=24.0, step=1.0)
-    
-    with col2:
-        bun = st.number_input("BUN (mg/dL)", min_value=0.0, value=40.0, step=1.0)
-        ph = st.number_input("pH Level", min_value=6.8, max_value=7.6, value=7.4, step=0.01)
-        uo = st.number_input("Urine Output 24h (ml)", min_value=0.0, value=1500.0, step=50.0)
+# Only this panel reruns when the form is submitted
+@st.fragment
+def patient_panel():
+    with st.form("patient_form"):
+        st.subheader("Patient Vitals & Labs")
         
-    st.subheader("Clinical Signs")
-    fluid = st.selectbox("Fluid Overload Grade", [0, 1, 2, 3], help="0=None, 3=Anasarca")
-    enceph = st.checkbox("Uremic Encephalopathy Present?")
-    
-    st.divider()
-    st.markdown("### 💾 Data Options")
-    save_data = st.checkbox("Contribute this case to AI Training Database?", value=False)
-    
-    # Submission Button
-    submitted = st.form_submit_button("Run Analysis")
-
-# ---------------------------------------------------------
-# 3. LOGIC & EXPLAINABILITY
-# ---------------------------------------------------------
-if submitted:
-    if model:
-        # 1. Create Dataframe
-        input_data = pd.DataFrame({
-            'creatinine': [cr], 'delta_Cr_24h': [delta_cr], 'potassium': [k],
-            'bicarbonate': [bicarb], 'bun': [bun], 'ph_level': [ph],
-            'fluid_overload_grade': [fluid], 'uremic_encephalopathy': [1 if enceph else 0],
-            'urine_output_24h': [uo]
-        })
-
-        # Ensure column order matches the brain
-        try:
-            input_data = input_data[model.feature_names_in_]
-        except:
-            pass
+        col1, col2 = st.columns(2)
+        with col1:
+            cr = st.number_input("Creatinine (mg/dL)", min_value=0.0, value=2.0, step=0.1)
+            delta_cr = st.number_input("Delta Cr (24h change)", value=0.0, step=0.1)
+            k = st.number_input("Potassium (mEq/L)", min_value=0.0, value=4.5, step=0.1)
+            bicarb = st.number_input("Bicarbonate (mEq/L)", min_value=0.0, value=24.0, step=1.0)
         
-        # 2. Predict
-        risk_prob_raw = model.predict_proba(input_data)[0][1]
-        risk_prob = float(risk_prob_raw)
+        with col2:
+            bun = st.number_input("BUN (mg/dL)", min_value=0.0, value=40.0, step=1.0)
+            ph = st.number_input("pH Level", min_value=6.8, max_value=7.6, value=7.4, step=0.01)
+            uo = st.number_input("Urine Output 24h (ml)", min_value=0.0, value=1500.0, step=50.0)
+            
+        st.subheader("Clinical Signs")
+        fluid = st.selectbox("Fluid Overload Grade", [0, 1, 2, 3], help="0=None, 3=Anasarca")
+        enceph = st.checkbox("Uremic Encephalopathy Present?")
         
-        # 3. Show Result
         st.divider()
-        st.metric(label="Dialysis Probability", value=f"{risk_prob:.1%}")
+        st.markdown("### 💾 Data Options")
+        save_data = st.checkbox("Contribute this case to AI Training Database?", value=False)
         
-        if risk_prob > 0.75:
-            st.error("🚨 HIGH RISK: Consider Dialysis Initiation")
-        elif risk_prob > 0.40:
-            st.warning("⚠️ MODERATE RISK: Monitor Closely")
-        else:
-            st.success("✅ LOW RISK: Conservative Management")
+        # Submission Button
+        submitted = st.form_submit_button("Run Analysis")
 
-        # -----------------------------------------------------
-        # 4. AUTHENTICITY CHECK (SHAP GRAPH)
-        # -----------------------------------------------------
-        st.subheader("🧠 Why did the AI make this decision?")
-        st.caption("Red bars = Increased Risk | Blue bars = Decreased Risk")
-        
-        with st.spinner("Generating clinical reasoning trace..."):
-            try:
-                # Calculate SHAP values
-                explainer = shap.TreeExplainer(model)
-                shap_values = explainer.shap_values(input_data)
-                
-                # Create the plot
-                fig, ax = plt.subplots(figsize=(8, 5))
-                # Note: We use the first row [0] because we are predicting for 1 patient
-                shap.plots.waterfall(
-                    shap.Explanation(
-                        values=shap_values[0], 
-                        base_values=explainer.expected_value, 
-                        data=input_data.iloc[0],
-                        feature_names=input_data.columns
-                    ),
-                    show=False
-                )
-                st.pyplot(fig)
-            except Exception as e:
-                st.warning(f"Could not generate explanation graph: {e}")
-
-        # 5. Save to Cloud
-        if save_data:
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            log_row = [
-                str(timestamp), float(cr), float(delta_cr), float(k), 
-                float(bicarb), float(bun), float(ph), int(fluid), 
-                int(enceph), float(uo), round(risk_prob, 3)
-            ]
+    # ---------------------------------------------------------
+    # 3. LOGIC & EXPLAINABILITY
+    # ---------------------------------------------------------
+    if submitted:
+        if model:
+            # 1. Build the feature row directly in the Brain's column order
+            patient = {
+                'creatinine': cr, 'delta_Cr_24h': delta_cr, 'potassium': k,
+                'bicarbonate': bicarb, 'bun': bun, 'ph_level': ph,
+                'fluid_overload_grade': fluid, 'uremic_encephalopathy': int(enceph),
+                'urine_output_24h': uo
+            }
+            input_data = st.session_state.xbuf
+            input_data[0] = [patient[name] for name in FEATURES]
+            
+            # 2. Predict
+            risk_prob = float(predict_risk(input_data)[0])
+
+            # Technical debug view, only rendered when the URL has ?debug=1
+            if ENABLE_DEBUG:
+                with st.expander("🛠️ Technical Debug"):
+                    st.write("Sending this data to the Brain:", pd.DataFrame(input_data, columns=FEATURES))
+            
+            # 3. Show Result
+            st.divider()
+            st.metric(label="Dialysis Probability", value=f"{risk_prob:.1%}")
             
-            with st.spinner("Saving to Research Database..."):
-                if add_to_database(log_row):
-                    st.toast("✅ Saved for training!", icon="🧬")
-    else:
-        st.error("⚠️ AI Brain (Model) not found. Check GitHub files.")
+            band = risk_band(np.array([risk_prob]))[0]
+            if band == "HIGH":
+                st.error("🚨 HIGH RISK: Consider Dialysis Initiation")
+            elif band == "MODERATE":
+                st.warning("⚠️ MODERATE RISK: Monitor Closely")
+            else:
+                st.success("✅ LOW RISK: Conservative Management")
+
+            # -----------------------------------------------------
+            # 4. AUTHENTICITY CHECK (SHAP GRAPH)
+            # -----------------------------------------------------
+            if ENABLE_SHAP:
+                st.subheader("🧠 Why did the AI make this decision?")
+                st.caption("Red bars = Increased Risk | Blue bars = Decreased Risk")
+                
+                with st.spinner("Generating clinical reasoning trace..."):
+                    try:
+                        # Calculate SHAP values
+                        shap_values = cached_shap(tuple(round(float(v), 3) for v in input_data.ravel()))
+                        
+                        # Plot the impacts, largest first
+                        import altair as alt
+                        impact = pd.DataFrame({
+                            "feature": FEATURES,
+                            "impact": shap_values,
+                            "color": np.where(shap_values > 0, "#ff0051", "#008bfb")
+                        }).sort_values("impact", key=np.abs, ascending=False)
+                        chart = alt.Chart(impact).mark_bar().encode(
+                            x=alt.X("impact:Q", title="Impact on risk (SHAP)"),
+                            y=alt.Y("feature:N", sort=None, title=None),
+                            color=alt.Color("color:N", scale=None)
+                        )
+                        st.altair_chart(chart, width="stretch")
+                    except Exception as e:
+                        st.warning(f"Could not generate explanation graph: {e}")
+
+            # 5. Save to Cloud
+            if save_data:
+                timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+                log_row = [
+                    timestamp, float(cr), float(delta_cr), float(k), 
+                    float(bicarb), float(bun), float(ph), int(fluid), 
+                    int(enceph), float(uo), round(risk_prob, 3)
+                ]
+                
+                st.session_state.pending_rows.append(log_row)
+                if len(st.session_state.pending_rows) >= SYNC_BATCH_SIZE:
+                    flush_pending_rows()
+                st.toast("✅ Queued for training!", icon="🧬")
+        else:
+            st.error("⚠️ AI Brain (Model) not found. Check GitHub files.")
+
+patient_panel()
+
+# ---------------------------------------------------------
+# 4. SYNC CONTROLS
+# ---------------------------------------------------------
+# Refreshes on its own so queue/upload status stays current between submits
+@st.fragment(run_every="10s")
+def sync_panel():
+    check_sync_jobs()
+    st.markdown("### ☁️ Research Database")
+    if st.button("Sync now", disabled=not st.session_state.pending_rows):
+        flush_pending_rows()
+    st.caption(f"{len(st.session_state.pending_rows)} case(s) waiting to upload")
+    if st.session_state.sync_jobs:
+        st.caption("⏳ Upload in progress...")
+
+with st.sidebar:
+    sync_panel()
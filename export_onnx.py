@@ -0,0 +1,41 @@
+"""Compile the Brain into an ONNX model for fast inference in app.py.
+
+Run once after retraining / re-saving Nephro_Brain_Final.pkl:
+
+    pip install onnxmltools onnxruntime
+    python export_onnx.py
+"""
+import copy
+
+import joblib
+import numpy as np
+import onnxruntime as ort
+from onnxmltools.convert import convert_xgboost
+from onnxmltools.convert.common.data_types import FloatTensorType
+
+MODEL_PATH = 'Nephro_Brain_Final.pkl'
+ONNX_PATH = 'Nephro_Brain_Final.onnx'
+
+model = joblib.load(MODEL_PATH)
+n_features = model.n_features_in_
+
+# The converter only understands positional feature names (f0, f1, ...)
+booster_model = copy.deepcopy(model)
+booster_model.get_booster().feature_names = None
+
+onx = convert_xgboost(
+    booster_model,
+    initial_types=[('X', FloatTensorType([None, n_features]))],
+    target_opset=15
+)
+with open(ONNX_PATH, 'wb') as f:
+    f.write(onx.SerializeToString())
+
+# Sanity check: the compiled model must agree with the original
+rng = np.random.default_rng(0)
+X = rng.uniform(0, 50, size=(256, n_features)).astype(np.float32)
+session = ort.InferenceSession(ONNX_PATH, providers=['CPUExecutionProvider'])
+onnx_prob = session.run(['probabilities'], {'X': X})[0][:, 1]
+max_diff = np.abs(onnx_prob - model.predict_proba(X)[:, 1]).max()
+assert max_diff < 1e-5, f"ONNX model disagrees with {MODEL_PATH} (max diff {max_diff})"
+print(f"Wrote {ONNX_PATH} (max probability diff {max_diff:.2e})")